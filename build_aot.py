@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+---===[ build_aot: radiomics-tools ]===---
+ Created on October 14, 2026
+ Copyright 2026 - Nick D. James and Rebecca E. Thornhill
+
+Compiles the numba kernels in raster.py ahead of time into the raster_kernels extension module (written next to this
+file), so that imj_dcm_to_nifti.py doesn't have to import numba and JIT-compile them on every run.  Re-run this after
+changing raster.py; otherwise the stale extension module will keep being used.
+
+Numba's AOT compiler doesn't support parallel=True, so the compiled scanline_fill works through the slices serially.
+
+No Parameters.
+"""
+import sys
+import os
+from inspect import signature
+from numba.pycc import CC
+import raster
+
+
+def main():
+    """See file header for description.
+    """
+    cc = CC('raster_kernels')
+    cc.output_dir = os.path.split(os.path.realpath(__file__))[0]
+    cc.export('scanline_fill', 'void(u1[:, :, ::1], f4[:, ::1], i4[::1], i4[::1])')(raster.scanline_fill.py_func)
+    cc.export('fill_axis_ellipse', 'void(u1[:, :, ::1], i8, i8, i8, i8, i8)')(raster.fill_axis_ellipse.py_func)
+    cc.compile()
+
+
+def usage():
+    print("Usage: build_aot " + " ".join(signature(main).parameters))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) - 1 != len(signature(main).parameters):
+        usage()
+    else:
+        main(*sys.argv[1:])
@@ -14,6 +14,12 @@ Four Parameters:
     * Path to a .zip file of ImageJ contours that match the images
     * Path to the output directory into which the .nii.gz file will be written (under the same name as its .zip file)
     * Value for the "region of boredom" (pixel values outside the regions of interest) -- default: 0
+
+With --batch, a whole cohort of studies is converted in parallel instead (see main_batch), given:
+    * Path to a directory containing one directory of DICOM images per study
+    * Path to a directory containing one directory (named the same) per study, holding that study's ImageJ .zip file
+    * Path to the output directory, in which a subdirectory is created for each study's .nii.gz files
+    * Number of worker processes -- default: 70% of the CPU cores
 """
 import sys
 import os
@@ -21,13 +27,22 @@ import logging
 import numpy as np
 import pydicom
 from pydicom import errors
+from pydicom.tag import Tag
 from inspect import signature
 from read_roi import read_roi_zip
 from zipfile import BadZipFile
-import skimage.draw
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import nibabel as nib
+from nibabel.fileholders import FileHolder
 import dicom2nifti
 import subprocess
+import gzip
+import tempfile
+try:
+    # Kernels compiled ahead of time by build_aot.py, so neither numba nor a JIT warm-up is on the critical path
+    from raster_kernels import scanline_fill, fill_axis_ellipse
+except ImportError:
+    from raster import scanline_fill, fill_axis_ellipse
 
 
 def get_parent_dir_of_this_file():
@@ -36,6 +51,8 @@ def get_parent_dir_of_this_file():
 
 def refresh_requirements_txt():
     """Executes `pip freeze > 'requirements.txt'`.  Use this to automate the version control of the virtualenv.
+    Running the script with the REFRESH_REQS environment variable set does this before anything else (it's a dev-time
+    chore, so ordinary runs don't pay for pip's start-up).
     """
     reqs = subprocess.check_output([sys.executable, '-m', 'pip', 'freeze'])
     filename = os.path.join(get_parent_dir_of_this_file(), 'requirements.txt')
@@ -45,7 +62,7 @@ def refresh_requirements_txt():
 
 def sort_names_numerically(filename_list):
     """Named after the checkbox in ImageJ's "Import --> Image Sequence" dialog box Sorts the given filename list the
-    same way ImageJ does if that checkbox is checked (and if the file is either not DICOM or the (0020, 0018) Instance
+    same way ImageJ does if that checkbox is checked (and if the file is either not DICOM or the (0020, 0013) Instance
     Number tag is blank): hierarchically, by sequence component (e.g. 7.55.8 < 7.123.2) rather than lexicographically
     (individual string components are, however, sorted lexicographically).
     :param filename_list: List of filenames that are .-delimited strings or numbrers with a .dcm extension.
@@ -55,29 +72,84 @@ def sort_names_numerically(filename_list):
             return int(s)
         except ValueError:
             return s
-    filename_list.sort(key=lambda filename: [int_or_str(x) for x in filename.split('.')[:-1]])
+    
+    # Build every sort key once, up front
+    keys = [[int_or_str(x) for x in filename.split('.')[:-1]] for filename in filename_list]
+    
+    # In the usual case, every name is the same number of integer components, so the keys stack into an integer
+    # array that numpy can lexsort in one go (lexsort sorts by its last key first, hence the reversal)
+    order = None
+    if keys and keys[0] and all(len(key) == len(keys[0]) and all(isinstance(x, int) for x in key) for key in keys):
+        try:
+            order = np.lexsort(np.array(keys, dtype=np.int64).T[::-1])
+        except OverflowError:
+            pass
+    if order is None:
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+    filename_list[:] = [filename_list[i] for i in order]
+
+
+def _has_dicm_magic(path):
+    """Checks for the "DICM" magic bytes that follow the 128-byte preamble of a DICOM file.  This is far cheaper than
+    letting pydicom raise InvalidDicomError on the .xml files, thumbnails, etc. that often share a directory with DICOMs.
+    :param path: Path to a (possibly) DICOM file
+    :return: True if the file has the DICOM magic bytes.
+    """
+    try:
+        with open(path, 'rb') as f:
+            f.seek(128)
+            return f.read(4) == b'DICM'
+    except OSError:
+        return False
+
+
+# Number of threads get_dcm_file_seq reads DICOM headers with (main_batch's workers use just 1)
+HEADER_READ_THREADS = 8
+
+# The only header tags we need: (0020, 0013) Instance Number, (0028, 0010) Rows and (0028, 0011) Columns
+HEADER_TAGS = [Tag(0x0020, 0x0013), Tag(0x0028, 0x0010), Tag(0x0028, 0x0011)]
+
+
+def _read_header(path):
+    """Reads only the HEADER_TAGS (Instance Number and image shape) from a DICOM file.  pydicom skips over the value of
+    every other element rather than parsing it.
+    :param path: Path to a (possibly) DICOM file
+    :return: The pydicom Dataset, or None if the file isn't DICOM.
+    """
+    # Only files named .dcm or carrying the DICOM magic bytes are worth handing to pydicom
+    if not (path.lower().endswith('.dcm') or _has_dicm_magic(path)):
+        return None
+    try:
+        return pydicom.dcmread(path, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+    except pydicom.errors.InvalidDicomError:
+        return None
 
 
 def get_dcm_file_seq(input_dir):
-    """Returns the list of DICOM filenames in input_dir, sorted in their sequence order.
+    """Returns the list of DICOM filenames in input_dir, sorted in their sequence order, and the image shape.
     Determining sequence order in a completely general, robust way can actually get surprisingly tricky.  Here,
     we're using a somewhat oversimplified approach (but it usually works...I think):
-    - If the (0020, 0018) Instance Number tag exists and is unique in all the DICOM files, we sort by those in
+    - If the (0020, 0013) Instance Number tag exists and is unique in all the DICOM files, we sort by those in
       increasing order.
     - Otherwise, sort according to ImageJ's "sort names numerically" feature.
     :param input_dir: Directory containing a sequence of DICOM images.
-    :return: List of DICOM filenames in input_dir, sorted in their sequence order.
+    :return: List of DICOM filenames in input_dir, sorted in their sequence order, and the (rows, columns) image shape
+             read from the first header (we're assuming all images in the sequence are the same size), or None if
+             there aren't any DICOM files.
     """
-    # Make a list of (filename, DICOM header)-pairs for all the DICOM files in input_dir
-    headers = []
-    for filename in os.listdir(input_dir):
-        try:
-            dcm = pydicom.dcmread(os.path.join(input_dir, filename), stop_before_pixels=True)
+    # Make a list of (filename, DICOM header)-pairs for all the DICOM files in input_dir.  scandir's entries already
+    # know whether they're regular files, so subdirectories etc. are dropped without any extra stat calls.  The header
+    # reads are I/O-bound (especially on network storage), so they're done on a thread pool.
+    with os.scandir(input_dir) as it:
+        entries = [entry for entry in it if entry.is_file()]
+    with ThreadPoolExecutor(max_workers=HEADER_READ_THREADS) as executor:
+        dcms = executor.map(_read_header, [entry.path for entry in entries])
         
-        # If filename is not a DICOM file, move on to the next one; otherwise add it to the list
-        except pydicom.errors.InvalidDicomError:
-            continue
-        headers.append((filename, dcm))
+        # If the entry is not a DICOM file, leave it out of the list
+        headers = [(entry.name, dcm) for entry, dcm in zip(entries, dcms) if dcm is not None]
+    
+    # The image shape is in the header, so there's no need to decode any pixels to find out the mask dimensions
+    img_shape = (headers[0][1].Rows, headers[0][1].Columns) if headers else None
     
     # If the Instance Number fields exist and are all unique, sort by those
     try:
@@ -91,87 +163,88 @@ def get_dcm_file_seq(input_dir):
             headers.sort(key=lambda x: x[1].InstanceNumber)
             
             # And return just the filenames (keeping the sort order)
-            return [x[0] for x in headers]
+            return [x[0] for x in headers], img_shape
         else:
             logging.warning("Duplicate instance numbers in %s", input_dir)
     
-    # If something went wrong just trying to LOOK at the Instance Numbers, log it.
-    except NotImplementedError:
+    # If something went wrong just trying to LOOK at the Instance Numbers (or they aren't there at all), log it.
+    except (NotImplementedError, AttributeError):
         logging.error("Corrupt/missing instance numbers in %s", input_dir)
     
     # If we can't sort by Instance Number, fall back on ImageJ's filename-based, header-independent sort
     filename_list = [x[0] for x in headers]
     sort_names_numerically(filename_list)
-    return filename_list
+    return filename_list, img_shape
 
 
-def roi_to_mask(roi_record, img, region_of_boredom_value=0):
-    """Rasterizes an ImageJ ROI record into a 2D numpy array containing 1s inside the ROI and a different value
-    outside it.
+def get_roi_paths(roi_record):
+    """Returns the polygon paths making up an ImageJ ROI record as a list of N x 2 arrays of (x, y) vertices.
     :param roi_record: ROI record from a .roi or .zip file
-    :param img: a numpy image array of the size and type wanted for the mask.
-    :param region_of_boredom_value: The filler value used for the background outside the ROI.
-    :return:
+    :return: List of contiguous float32 N x 2 arrays (empty if the ROI isn't made of polygons, e.g. ovals).
     """
-    mask = region_of_boredom_value * np.ones_like(img)
     roi_record_type = roi_record['type']
     if roi_record_type == "freehand":
-        
-        # Get the x,y-coords of all points inside ROI
-        r, c = np.asarray(roi_record['x']), np.asarray(roi_record['y'])
-        mask[skimage.draw.polygon(r, c)] = 1
-    
-    elif roi_record_type == "oval":
-        logging.warning("Oval ROI to NIfTI is untested.  Check " + roi_record['name'] + " carefully!")
-        top, left = roi_record['top'], roi_record['left']
-        width, height = roi_record['width'], roi_record['height']
-        
-        # ImageJ puts y=0 at the top of the image
-        h_radius, w_radius = height // 2, width // 2
-        c, r = top + h_radius, left + w_radius
-        mask[skimage.draw.ellipse(r=r, c=c, r_radius=h_radius, c_radius=w_radius)] = 1
-    
-    # A "composite" contour is a dict with a list of paths (roi_record['paths']).
-    # Each path is a list of (x,y) pairs.
-    # 'top', 'left', 'width', 'height' are keys for the dimensions of the bounding box containing all paths.
+        return [np.ascontiguousarray(np.column_stack((roi_record['x'], roi_record['y'])), dtype=np.float32)]
     elif roi_record_type == 'composite':
-        for p in roi_record['paths']:
-            p = np.asarray(p)
-            r, c = np.asarray(p)[:, 0], np.asarray(p)[:, 1]
-            mask[skimage.draw.polygon(r, c)] = 1
-    else:
-        logging.error("Unrecognized ROI record type: \"%s\"",
-                      roi_record['name'], roi_record_type, roi_record_type)
-    return mask
+        return [np.ascontiguousarray(p, dtype=np.float32) for p in roi_record['paths']]
+    return []
+
+
+def _roi_to_numpy_record(roi_record):
+    """Converts an ROI record's vertex lists to numpy once, up front, storing them (as returned by get_roi_paths)
+    under its '_xy' key.
+    :param roi_record: ROI record from a .roi or .zip file, updated in place
+    :return: roi_record
+    """
+    roi_record['_xy'] = get_roi_paths(roi_record)
+    return roi_record
 
 
-def rois_to_mask_stack(roi_odict, input_dir, dcm_list):
-    """Creates numpy array mask from an ImageJ ROI and loads the corresponding DICOM image into another np array.
+def rois_to_mask_stack(roi_odict, img_shape, dcm_list, region_of_boredom_value=0):
+    """Creates a 3D numpy array of masks (one slice per DICOM image) from the ImageJ ROIs of an RoiSet zip file.
     :param roi_odict: The contents of an RoiSet zip file produced by read_roi_zip
-    :param input_dir: Directory containing the DICOM files for this RoiSet zip file
+    :param img_shape: (rows, columns) shape of the DICOM images for this RoiSet zip file
     :param dcm_list: List of DICOM filenames
+    :param region_of_boredom_value: The filler value used for the background outside the ROIs.
     """
-    # Load the first image in `dcm_list` to see what the mask dimensions should be.  (Note: we're assuming all images
-    # in the list are the same size)
-    input_filename = os.path.join(input_dir, dcm_list[0])
-    try:
-        dicom_record = pydicom.dcmread(input_filename)
-        img = dicom_record.pixel_array.astype(float)
-    except TypeError:
-        logging.error("Could not access Pixel Data in %s", input_filename)
-        return
-    
-    # Create H x W x D array of zeros to hold masks
-    mask_shape = tuple(list(img.shape) + [len(dcm_list)])
-    mask = np.zeros(mask_shape)
-    
-    # Convert each ROI record to a slice in the 3D mask
-    for roi_record in roi_odict.values():
-        # The 'position' field in the ROI record contains the index of the corresponding .dcm file
-        i = int(roi_record['position']) - 1
+    # Create H x W x D array to hold masks.  It's backed by an anonymous temporary file rather than RAM, so only the
+    # pages actually being rasterized or saved need to be resident (important for very large studies).  A new file
+    # starts out as zeros that the OS fills in lazily, so blank slices are never even touched.
+    mask_shape = tuple(img_shape) + (len(dcm_list),)
+    with tempfile.TemporaryFile() as f:
+        mask = np.memmap(f, mode='w+', dtype=np.uint8, shape=mask_shape)
+    if region_of_boredom_value != 0:
+        mask[:] = region_of_boredom_value
+    
+    # The 'position' field in each ROI record contains the (1-based) index of the corresponding .dcm file
+    roi_records = list(roi_odict.values())
+    positions = np.fromiter((int(r['position']) - 1 for r in roi_records), dtype=np.int32, count=len(roi_records))
+    valid = (positions >= 0) & (positions < len(dcm_list))
+    for j in np.flatnonzero(~valid):
+        logging.error("Skip ROI %s (position %d is outside the %d DICOM images)",
+                      roi_records[j]['name'], positions[j] + 1, len(dcm_list))
+    
+    # Gather the polygon paths of every ROI record into one flat vertex array for the scanline-fill kernel, visiting
+    # the records in slice order so that the paths on each slice are contiguous.  (Records from get_dicom_roi_seqs
+    # already have their paths converted to numpy.)
+    xys, slc = [], []
+    for j in np.flatnonzero(valid)[np.argsort(positions[valid], kind='stable')]:
+        roi_record, i = roi_records[j], positions[j]
+        paths = roi_record['_xy'] if '_xy' in roi_record else get_roi_paths(roi_record)
+        xys.extend(paths)
+        slc.extend([i] * len(paths))
         
-        # Rasterize the ROI and record it at position i
-        mask[:, :, i] = roi_to_mask(roi_record, img)
+        # Ovals are rasterized straight into position i
+        if roi_record['type'] == "oval":
+            logging.warning("Oval ROI to NIfTI is untested.  Check " + roi_record['name'] + " carefully!")
+            fill_axis_ellipse(mask, i, roi_record['left'], roi_record['top'], roi_record['width'], roi_record['height'])
+        elif not paths:
+            logging.error("Unrecognized ROI record type in %s: \"%s\"", roi_record['name'], roi_record['type'])
+    
+    if xys:
+        offs = np.cumsum([0] + [len(xy) for xy in xys]).astype(np.int32)
+        slice_offs = np.searchsorted(slc, np.arange(len(dcm_list) + 1)).astype(np.int32)
+        scanline_fill(mask, np.concatenate(xys), offs, slice_offs)
     return mask
 
 
@@ -179,29 +252,31 @@ def get_dicom_roi_seqs(input_dir, roi_set_zip_file):
     """Gets an iterator of ROIs from a .zip file and the list of all DICOM images in the corresponding directory.
     :param input_dir: path containing the DICOM images
     :param roi_set_zip_file: path to the RoiSet.zip file containing the regions of interest
-    :returns: iterator of ROIs, list of DICOM files
+    :returns: iterator of ROIs, list of DICOM files, (rows, columns) shape of the DICOM images
     """
     # Read the ROI zip file sitting in the input dir
     roi_odict = None
     try:
         roi_odict = read_roi_zip(roi_set_zip_file)
+        for roi_record in roi_odict.values():
+            _roi_to_numpy_record(roi_record)
     except (BadZipFile, UnboundLocalError):
         logging.error("Skip dir (bad RoiSet.zip file): " + roi_set_zip_file)
     
     # Get the list of DICOM filenames of this sequence in their proper order
-    dcm_seq = get_dcm_file_seq(input_dir)
+    dcm_seq, img_shape = get_dcm_file_seq(input_dir)
     
     # If there aren't any DICOMs, that's messed up.  Please make a note of it.
     if dcm_seq:
         logging.info("%d dicom images in %s", len(dcm_seq), input_dir)
     else:
         logging.error("RoiSet.zip file with no DICOM files in %s", input_dir)
-    return roi_odict, dcm_seq
+    return roi_odict, dcm_seq, img_shape
 
 
 def mask_arr_to_nifti1_file(mask_arr, zip_file, output_path):
     """Writes mask array to NIfTI file.
-    :param mask_arr: 3D numpy array of floats (3rd axis is slice number)
+    :param mask_arr: 3D numpy array of uint8s (3rd axis is slice number)
     :param zip_file: path to ImageJ ROI .zip file
     :param output_path: path to output nifti file
     """
@@ -211,7 +286,19 @@ def mask_arr_to_nifti1_file(mask_arr, zip_file, output_path):
     # nifti_img = nib.Nifti1Image(mask_arr, affine=affine)
     nifti_img = nib.Nifti1Image(mask_arr, affine=np.eye(4))
     output_file = os.path.join(output_path, os.path.split(os.path.splitext(zip_file)[0])[1]) + ".nii.gz"
-    nib.save(nifti_img, output_file)
+    
+    # Binary masks compress to within a few percent of gzip level 9 at level 1, for a fraction of the CPU time.  (That's
+    # nibabel's default too, but we spell it out rather than rely on it.)
+    with gzip.GzipFile(output_file, 'wb', compresslevel=1) as gz:
+        nifti_img.to_file_map({'image': FileHolder(fileobj=gz)})
+
+
+def set_up_logging(level=logging.WARNING):
+    """Sets up the logging module to log to a file next to this one (unless this process has already set it up).
+    :param level: Lowest level of message to write
+    """
+    log_filename = __file__ + ".log"
+    logging.basicConfig(filename=log_filename, format="%(levelname)s: %(message)s", level=level)
 
 
 def main(dicom_dir, roi_zip_path, output_dir):
@@ -221,14 +308,13 @@ def main(dicom_dir, roi_zip_path, output_dir):
     :param output_dir: Directory in which to put the NIfTI mask file
     """
     # Set up the logging module
-    log_filename = __file__ + ".log"
-    logging.basicConfig(filename=log_filename, format="%(levelname)s: %(message)s", level=logging.WARNING)
+    set_up_logging()
 
-    # Get the ordered dictionary of ROIs and the list of DICOM files
-    ordd_dict, dcm_seq = get_dicom_roi_seqs(dicom_dir, roi_zip_path)
+    # Get the ordered dictionary of ROIs, the list of DICOM files and the shape of their images
+    ordd_dict, dcm_seq, img_shape = get_dicom_roi_seqs(dicom_dir, roi_zip_path)
     
     # Create the X x Y x Z numpy array of masks
-    mask_arr = rois_to_mask_stack(ordd_dict, dicom_dir, dcm_seq)
+    mask_arr = rois_to_mask_stack(ordd_dict, img_shape, dcm_seq)
     
     # Write NIfTI file containing the masks
     mask_arr_to_nifti1_file(mask_arr, roi_zip_path, output_dir)
@@ -239,13 +325,85 @@ def main(dicom_dir, roi_zip_path, output_dir):
     dicom2nifti.dicom_series_to_nifti(dicom_dir, images_file, reorient_nifti=False)
 
 
+def find_studies(dicom_root, roi_root):
+    """Pairs up each directory of DICOM images in dicom_root with the ImageJ ROI .zip file drawn on it.  The .zip file
+    for dicom_root/<study> is expected to be the only one in roi_root/<study> (roi_root can simply be dicom_root, if the
+    .zip files sit in with the DICOM images).
+    :param dicom_root: Directory containing one directory of DICOM images per study
+    :param roi_root: Directory containing one directory (named the same as in dicom_root) per study
+    :return: List of (study name, DICOM directory, .zip file path) triples, sorted by study name
+    """
+    studies = []
+    for name in sorted(os.listdir(dicom_root)):
+        dicom_dir, roi_dir = os.path.join(dicom_root, name), os.path.join(roi_root, name)
+        if not (os.path.isdir(dicom_dir) and os.path.isdir(roi_dir)):
+            continue
+        zip_files = [f for f in os.listdir(roi_dir) if f.lower().endswith('.zip')]
+        if len(zip_files) == 1:
+            studies.append((name, dicom_dir, os.path.join(roi_dir, zip_files[0])))
+        else:
+            logging.error("Skip study (expected 1 ROI .zip file, found %d): %s", len(zip_files), roi_dir)
+    return studies
+
+
+def _init_batch_worker():
+    """Sets up a main_batch worker process.  The pool already runs about one study per core, so each worker's numba
+    kernels and DICOM header reads are kept to a single thread rather than every worker trying to use every core.
+    """
+    global HEADER_READ_THREADS
+    HEADER_READ_THREADS = 1
+    
+    # Only the JIT-compiled kernels are multithreaded (and only they need numba at all)
+    if 'numba' in sys.modules:
+        sys.modules['numba'].set_num_threads(1)
+    
+    # Log at the same level as main_batch, whether the worker was forked from it or spawned afresh
+    set_up_logging(logging.INFO)
+
+
+def main_batch(dicom_root, roi_root, output_dir, workers=None):
+    """Runs main on every study found by find_studies, in parallel with one study per process.  Each study's NIfTI
+    files are written to its own subdirectory of output_dir.
+    :param dicom_root: Directory containing one directory of DICOM images per study
+    :param roi_root: Directory containing one directory (named the same as in dicom_root) per study, holding its ImageJ
+                     ROI .zip file
+    :param output_dir: Directory in which to put the per-study output directories
+    :param workers: Number of worker processes -- default: 70% of the CPU cores
+    """
+    # Set up the logging module, including INFO messages so that each study's completion is recorded as it happens
+    set_up_logging(logging.INFO)
+    
+    workers = int(workers) if workers else max(1, int(os.cpu_count() * 0.7))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker) as executor:
+        futures = {}
+        for name, dicom_dir, roi_zip_path in find_studies(dicom_root, roi_root):
+            study_output_dir = os.path.join(output_dir, name)
+            os.makedirs(study_output_dir, exist_ok=True)
+            futures[executor.submit(main, dicom_dir, roi_zip_path, study_output_dir)] = name
+        
+        # Report each study as soon as it's done, whatever order they finish in
+        for future in as_completed(futures):
+            try:
+                future.result()
+                logging.info("Finished study %s", futures[future])
+            except Exception:
+                logging.exception("Failed study %s", futures[future])
+
+
 def usage():
     print("Usage: imagej_rois_to_nifti " + " ".join(signature(main).parameters))
+    print("       imagej_rois_to_nifti --batch " + " ".join(signature(main_batch).parameters))
 
 
 if __name__ == "__main__":
-    refresh_requirements_txt()
-    if len(sys.argv) - 1 != len(signature(main).parameters):
+    if os.environ.get('REFRESH_REQS'):
+        refresh_requirements_txt()
+    if sys.argv[1:2] == ['--batch']:
+        if len(sys.argv) - 2 not in (len(signature(main_batch).parameters) - 1, len(signature(main_batch).parameters)):
+            usage()
+        else:
+            main_batch(*sys.argv[2:])
+    elif len(sys.argv) - 1 != len(signature(main).parameters):
         usage()
     else:
         main(*sys.argv[1:])
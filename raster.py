@@ -0,0 +1,125 @@
+"""
+---===[ raster: radiomics-tools ]===---
+ Created on October 14, 2026
+ Copyright 2026 - Nick D. James and Rebecca E. Thornhill
+
+Numba kernels that rasterize ImageJ ROIs straight into a 3D (H x W x D) uint8 mask stack.  These are JIT-compiled on
+first use; build_aot.py compiles the same functions ahead of time into the raster_kernels extension module, which
+imj_dcm_to_nifti.py prefers when it's available.
+"""
+import numpy as np
+from numba import njit, prange
+
+
+@njit(cache=True)
+def _insort(crossings, k, c):
+    """Inserts c into the sorted first k entries of crossings (insertion sort: there are only ever a handful of
+    crossings per row).
+    :return: The new number of sorted entries, k + 1
+    """
+    i = k
+    while i > 0 and crossings[i - 1] > c:
+        crossings[i] = crossings[i - 1]
+        i -= 1
+    crossings[i] = c
+    return k + 1
+
+
+@njit(parallel=True, cache=True)
+def scanline_fill(mask, xy, offs, slice_offs):
+    """Scanline-fills a batch of polygon paths into a 3D mask, in parallel over slices.  Each path is filled
+    independently, so overlapping paths and ROIs on the same slice accumulate rather than overwrite.
+    Pixels are chosen by the same rule as skimage.draw.polygon (O'Rourke's point-in-polygon test): a pixel is filled if
+    it is a vertex, or if an odd number of edges cross its row either strictly after it or strictly before it.  So
+    pixels inside the path or exactly on its boundary are filled (e.g. a square with integer corners 0 and 4 fills
+    5 x 5 pixels).
+    :param mask: H x W x D uint8 mask array, filled in place with 1s
+    :param xy: contiguous float32 N x 2 array of the concatenated (x, y) vertices of every path (x along the first mask
+               axis, y along the second)
+    :param offs: int32 array of the start index of each path in xy, plus a final entry of len(xy)
+    :param slice_offs: int32 array of the index (into offs) of the first path on each slice (third mask axis), plus a
+                       final entry of the number of paths.  I.e. paths must be grouped by slice, in slice order.
+    """
+    n_rows, n_cols = mask.shape[0], mask.shape[1]
+    for z in prange(mask.shape[2]):
+        for p in range(slice_offs[z], slice_offs[z + 1]):
+            start, stop = offs[p], offs[p + 1]
+            if stop - start < 3:
+                continue
+            after = np.empty(stop - start, dtype=np.float64)
+            before = np.empty(stop - start, dtype=np.float64)
+            r_lo = max(int(np.ceil(xy[start:stop, 0].min())), 0)
+            r_hi = min(int(np.floor(xy[start:stop, 0].max())), n_rows - 1)
+            for r in range(r_lo, r_hi + 1):
+                
+                # Collect the (sorted) y-coords where the path's edges cross row r, once with the edges half-open
+                # towards +x and once towards -x, so that edges ending exactly on the row are counted once in each
+                k_after = k_before = 0
+                for j in range(start, stop):
+                    j_next = j + 1 if j + 1 < stop else start
+                    x0, y0 = np.float64(xy[j, 0]), np.float64(xy[j, 1])
+                    x1, y1 = np.float64(xy[j_next, 0]), np.float64(xy[j_next, 1])
+                    
+                    # Vertices are always filled
+                    if x0 == r and y0 == np.floor(y0) and 0 <= y0 < n_cols:
+                        mask[r, int(y0), z] = 1
+                    crosses_after, crosses_before = (x0 > r) != (x1 > r), (x0 < r) != (x1 < r)
+                    if crosses_after or crosses_before:
+                        c = y0 + (r - x0) * (y1 - y0) / (x1 - x0)
+                        if crosses_after:
+                            k_after = _insort(after, k_after, c)
+                        if crosses_before:
+                            k_before = _insort(before, k_before, c)
+                
+                # Odd numbers of crossings strictly after pixel c: c in [after[0], after[1]), [after[2], after[3]), ...
+                for i in range(0, k_after - 1, 2):
+                    c_lo = max(int(np.ceil(after[i])), 0)
+                    c_hi = min(int(np.ceil(after[i + 1])) - 1, n_cols - 1)
+                    if c_lo <= c_hi:
+                        mask[r, c_lo:c_hi + 1, z] = 1
+                
+                # Odd numbers of crossings strictly before pixel c: c in (before[0], before[1]], ...
+                for i in range(0, k_before - 1, 2):
+                    c_lo = max(int(np.floor(before[i])) + 1, 0)
+                    c_hi = min(int(np.floor(before[i + 1])), n_cols - 1)
+                    if c_lo <= c_hi:
+                        mask[r, c_lo:c_hi + 1, z] = 1
+
+
+@njit(cache=True)
+def fill_axis_ellipse(mask, z, left, top, width, height):
+    """Fills an axis-aligned ellipse (an ImageJ oval ROI) into slice z of a 3D mask, one span per row.  The boundary is
+    walked incrementally with integer arithmetic only (in the manner of Van Aken's midpoint ellipse algorithm), so the
+    cost is O(width + height) on top of the span writes.
+    :param mask: H x W x D uint8 mask array, filled in place with 1s
+    :param z: Slice (third mask axis) index
+    :param left: ImageJ x-coord (first mask axis) of the oval's bounding box
+    :param top: ImageJ y-coord (second mask axis) of the oval's bounding box
+    :param width: Width (along the first mask axis) of the oval's bounding box
+    :param height: Height (along the second mask axis) of the oval's bounding box
+    """
+    # Work in doubled coordinates relative to the centre, so pixel centres (and the centre itself) are all integers:
+    # pixel (x, y) has X = 2 * (x - left) + 1 - width and Y = 2 * (y - top) + 1 - height, and it's inside the oval iff
+    # e = X^2 * height^2 + Y^2 * width^2 - width^2 * height^2 <= 0.
+    w2, h2 = np.int64(width) * width, np.int64(height) * height
+    
+    # Start at the row nearest the centre, at the outermost Y, and step outwards one row (X += 2) at a time, pulling Y
+    # in (Y -= 2) until the pixel is back inside.  Y never has to move back out, so each step is just a few adds.
+    big_x = (width - 1) % 2
+    big_y = height - 1
+    e = big_x * big_x * h2 + big_y * big_y * w2 - w2 * h2
+    while big_x < width:
+        while big_y >= 0 and e > 0:
+            e += (4 - 4 * big_y) * w2
+            big_y -= 2
+        if big_y < 0:
+            break
+        
+        # Fill the span on this row and its mirror image on the other side of the centre
+        c_lo = max(top + (height - 1 - big_y) // 2, 0)
+        c_hi = min(top + (height - 1 + big_y) // 2, mask.shape[1] - 1)
+        for r in (left + (width - 1 + big_x) // 2, left + (width - 1 - big_x) // 2):
+            if 0 <= r < mask.shape[0] and c_lo <= c_hi:
+                mask[r, c_lo:c_hi + 1, z] = 1
+        e += (4 * big_x + 4) * h2
+        big_x += 2
@@ -0,0 +1,72 @@
+"""
+---===[ test_raster: radiomics-tools ]===---
+ Created on October 14, 2026
+ Copyright 2026 - Nick D. James and Rebecca E. Thornhill
+
+Checks that the raster.py kernels fill the same pixels as skimage.draw.polygon, which the masks were originally
+rasterized with.  Run with `python -m pytest`.
+"""
+import numpy as np
+import skimage.draw
+import raster
+
+SHAPE = (48, 40)
+
+
+def fill_paths(paths, shape=SHAPE):
+    """Rasterizes a list of (x, y) vertex arrays onto slice 0 of a 1-slice mask with scanline_fill.
+    """
+    xys = [np.ascontiguousarray(p, dtype=np.float32) for p in paths]
+    mask = np.zeros(shape + (1,), dtype=np.uint8)
+    offs = np.cumsum([0] + [len(xy) for xy in xys]).astype(np.int32)
+    raster.scanline_fill(mask, np.concatenate(xys), offs, np.array([0, len(xys)], dtype=np.int32))
+    return mask[:, :, 0]
+
+
+def skimage_paths(paths, shape=SHAPE):
+    """Rasterizes the same paths the way the baseline did, with skimage.draw.polygon.
+    """
+    mask = np.zeros(shape, dtype=np.uint8)
+    for p in paths:
+        p = np.asarray(p, dtype=np.float32).astype(float)
+        mask[skimage.draw.polygon(p[:, 0], p[:, 1], shape)] = 1
+    return mask
+
+
+def random_polygons(rng, n_polygons, integer):
+    """Yields random polygons inside (and partly outside) the mask: half star-shaped, half arbitrary (so mostly
+    self-intersecting).
+    """
+    for i in range(n_polygons):
+        n = rng.integers(3, 20)
+        if i % 2:
+            theta, radius = np.sort(rng.uniform(0, 2 * np.pi, n)), rng.uniform(2, 25, n)
+            x, y = 24 + radius * np.cos(theta), 20 + radius * np.sin(theta)
+        else:
+            x, y = rng.uniform(-3, SHAPE[0] + 3, n), rng.uniform(-3, SHAPE[1] + 3, n)
+        if integer:
+            x, y = np.round(x), np.round(y)
+        yield np.column_stack((x, y))
+
+
+def test_integer_rectangle_includes_boundary():
+    assert fill_paths([[(5, 5), (20, 5), (20, 30), (5, 30)]]).sum() == 16 * 26
+    assert fill_paths([[(0, 0), (4, 0), (4, 4), (0, 4)]]).sum() == 5 * 5
+
+
+def test_matches_skimage_on_integer_polygons():
+    rng = np.random.default_rng(0)
+    for p in random_polygons(rng, 300, integer=True):
+        np.testing.assert_array_equal(fill_paths([p]), skimage_paths([p]))
+
+
+def test_matches_skimage_on_float_polygons():
+    rng = np.random.default_rng(1)
+    for p in random_polygons(rng, 300, integer=False):
+        np.testing.assert_array_equal(fill_paths([p]), skimage_paths([p]))
+
+
+def test_paths_on_a_slice_accumulate():
+    rng = np.random.default_rng(2)
+    paths = list(random_polygons(rng, 4, integer=True))
+    np.testing.assert_array_equal(fill_paths(paths), skimage_paths(paths))